@@ -12,237 +12,314 @@ except ImportError:
     import sys
     sys.exit(1)
 
-from collections import defaultdict
+# symusic is optional; its C++ MIDI parser is much faster than mido on
+# large files. Fall back to mido when it is not installed.
+try:
+    import symusic
+except ImportError:
+    symusic = None
+
+from array import array
+from bisect import bisect_right
+from collections import defaultdict, deque
+from itertools import groupby
+from operator import itemgetter
 import sys
+import threading
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
 import os
 
-# Map General MIDI instrument numbers (0-127) to Scratch instruments (1-21)
+# Pre-formatted MIDI note numbers (0-127) for the 'Note:' lines
+_NOTE_BYTES = [b'%d' % note for note in range(128)]
+
+
+# Map General MIDI instrument numbers (0-127) to Scratch instruments (1-21).
+# Built once at import time as a 128-entry lookup table.
+_GM_LUT = bytearray(128)
+for _start, _end, _scratch_inst in (
+    (0, 2, 1),     (2, 8, 2),     (8, 9, 16),
+    (9, 11, 17),   (11, 16, 19),  (16, 24, 3),
+    (24, 28, 4),   (28, 32, 5),   (32, 40, 6),
+    (40, 44, 8),   (44, 48, 7),   (48, 52, 8),
+    (52, 56, 15),  (56, 64, 9),   (64, 68, 11),
+    (68, 72, 10),  (72, 74, 12),  (74, 80, 13),
+    (80, 88, 20),  (88, 96, 21),  (96, 104, 21),
+    (104, 108, 13), (108, 112, 4), (112, 116, 18),
+    (116, 120, 19), (120, 128, 21),
+):
+    _GM_LUT[_start:_end] = bytes([_scratch_inst]) * (_end - _start)
+del _start, _end, _scratch_inst
+
+
 def gm_to_scratch_instrument(gm_program):
     """Convert General MIDI program number to Scratch instrument (1-21)"""
-    instrument_map = {
-        range(0, 2): 1,    range(2, 8): 2,    range(8, 9): 16,
-        range(9, 11): 17,  range(11, 16): 19, range(16, 24): 3,
-        range(24, 28): 4,  range(28, 32): 5,  range(32, 40): 6,
-        range(40, 44): 8,  range(44, 48): 7,  range(48, 52): 8,
-        range(52, 56): 15, range(56, 64): 9,  range(64, 68): 11,
-        range(68, 72): 10, range(72, 74): 12, range(74, 80): 13,
-        range(80, 88): 20, range(88, 96): 21, range(96, 104): 21,
-        range(104, 108): 13, range(108, 112): 4, range(112, 116): 18,
-        range(116, 120): 19, range(120, 128): 21,
-    }
-    
-    for program_range, scratch_inst in instrument_map.items():
-        if gm_program in program_range:
-            return scratch_inst
-    return 1
+    return _GM_LUT[gm_program]
+
+
+# (upper bound, rounded value) pairs for common musical note durations,
+# sorted by upper bound so a beat value can be located with a binary search
+_BEAT_ROUNDING = (
+    (0.027, 0.03125),  # 128th note
+    (0.035, 0.04),     # triplet 64th note
+    (0.045, 0.05),     # dotted 64th note
+    (0.0615, 0.0625),  # 64th note
+    (0.0825, 0.0833),  # triplet 32th note
+    (0.1, 0.125),      # 32th note
+    (0.15, 0.166),     # triplet 16th note
+    (0.2, 0.25),       # 16th note
+    (0.3, 0.33),       # triplet 8th note
+    (0.4, 0.5),        # 8th note
+    (0.6, 0.75),       # 8th note + 16th note
+    (0.8, 1),          # quarter note
+    (1.3, 1.5),        # dotted quarter
+    (2.5, 2),          # half note
+    (3.5, 3),          # dotted half
+    (4.5, 4),          # whole note
+    (6.5, 6),          # dotted whole note
+    (7.5, 7),          # triplet whole note
+    (8.5, 8),          # double whole note
+    (10.5, 10),        # dotted double whole note
+    (11.5, 11),        # triplet double whole note
+    (12.5, 12),        # triple whole note
+    (14.5, 14),        # dotted triple whole note
+    (15.5, 15),        # triplet triple whole note
+    (16.5, 16),        # quadruple whole note
+)
+_BEAT_THRESHOLDS = tuple(bound for bound, _ in _BEAT_ROUNDING)
+_BEAT_VALUES = tuple(value for _, value in _BEAT_ROUNDING)
 
 
 def round_to_musical_beat(beat_value):
     """Round a beat value to common musical note durations"""
-    if beat_value < 0.027:
-        return 0.03125  # 128th note
-    elif beat_value < 0.035:
-        return 0.04     # triplet 64th note
-    elif beat_value < 0.045:
-        return 0.05     # dotted 64th note
-    elif beat_value < 0.0615:
-        return 0.0625   # 64th note
-    elif beat_value < 0.0825:
-        return 0.0833  # triplet 32th note
-    elif beat_value < 0.05:
-        return 0.1      # dotted 32th note
-    elif beat_value < 0.1:
-        return 0.125   # 32th note
-    elif beat_value < 0.15:
-        return 0.166  # triplet 16th note
-    elif beat_value < 0.2:
-        return 0.25   # 16th note
-    elif beat_value < 0.3:
-        return 0.33   # triplet 8th note
-    elif beat_value < 0.4:
-        return 0.5    # 8th note
-    elif beat_value < 0.6:
-        return 0.75   # 8th note + 16th note
-    elif beat_value < 0.8:
-        return 1      # quarter note
-    elif beat_value < 1.3:
-        return 1.5    # dotted quarter
-    elif beat_value < 2.5:
-        return 2      # half note
-    elif beat_value < 3.5:
-        return 3      # dotted half
-    elif beat_value < 4.5:
-        return 4      # whole note
-    elif beat_value < 6.5:
-        return 6      # dotted whole note
-    elif beat_value < 7.5:
-        return 7      # triplet whole note
-    elif beat_value < 8.5:   
-        return 8      # double whole note
-    elif beat_value < 10.5:
-        return 10     # dotted double whole note
-    elif beat_value < 11.5:
-        return 11     # triplet double whole note
-    elif beat_value < 12.5:
-        return 12     # triple whole note
-    elif beat_value < 14.5:
-        return 14     # dotted triple whole note
-    elif beat_value < 15.5:
-        return 15     # triplet triple whole note
-    elif beat_value < 16.5:
-        return 16     # quadruple whole note 
-    else:
-        return round(beat_value, 2)  # Keep 2 decimal places for longer notes
+    i = bisect_right(_BEAT_THRESHOLDS, beat_value)
+    if i < len(_BEAT_VALUES):
+        return _BEAT_VALUES[i]
+    return round(beat_value, 2)  # Keep 2 decimal places for longer notes
 
 
-def midi_to_scratch(midi_file, output_file, progress_callback=None):
-    """Convert MIDI file to Scratch-compatible format"""
+def _group_chords(note_ons, tolerance_ticks, progress_callback=None):
+    """Group time-sorted (time, note, instrument) note_ons into (tick, notes, instrument) chords"""
+    total_events = len(note_ons)
+    last_pct = -1
+    chords = []
     
-    try:
-        mid = mido.MidiFile(midi_file)
-    except Exception as e:
-        return False, f"Error reading MIDI file: {e}"
+    # Fast path for quantized files (most DAW exports): while no two distinct
+    # onsets fall within the tolerance, each chord is exactly the notes
+    # sharing one tick, which groupby finds without any index arithmetic
+    i = 0
+    previous_start = None
+    for chord_start, group in groupby(note_ons, key=itemgetter(0)):
+        if previous_start is not None and chord_start - previous_start <= tolerance_ticks:
+            # This onset belongs in the previous chord's window; redo that
+            # chord and everything after it with the sweep below
+            i -= len(chords.pop()[1])
+            break
+        
+        # Only report whole-percent changes; each report pumps the Tk loop
+        if progress_callback:
+            pct = i * 100 // total_events
+            if pct != last_pct:
+                progress_callback(pct)
+                last_pct = pct
+        
+        first = next(group)
+        # MIDI note numbers fit in a byte, so keep chord notes unboxed
+        chord_notes = array('B')
+        chord_notes.append(first[1])
+        for event in group:
+            chord_notes.append(event[1])
+        
+        chords.append((chord_start, chord_notes, first[2]))
+        previous_start = chord_start
+        i += len(chord_notes)
     
-    ticks_per_beat = mid.ticks_per_beat
-    events = []
-    current_tempo = 500000
-    tempo_changes = {0: current_tempo}
+    # Whatever is left is grouped with a single linear sweep: a new chord
+    # opens whenever a note falls outside the current window
+    while i < total_events:
+        if progress_callback:
+            pct = i * 100 // total_events
+            if pct != last_pct:
+                progress_callback(pct)
+                last_pct = pct
+        
+        chord_start = note_ons[i][0]
+        chord_notes = array('B')
+        j = i
+        while j < total_events and note_ons[j][0] - chord_start <= tolerance_ticks:
+            chord_notes.append(note_ons[j][1])
+            j += 1
+        
+        chords.append((chord_start, chord_notes, note_ons[i][2]))
+        i = j
+    
+    return chords
+
+
+def _emit_lines(write, chords, tempo_changes, ticks_per_beat, bpm, first_instrument):
+    """Write the Scratch lines for time-sorted chords and tempo changes, returning the line count"""
+    # Each line is written with a leading newline, so the file has no trailing one
+    # Bind hot names locally; this loop runs once per chord
+    round_beat = round_to_musical_beat
+    note_bytes = _NOTE_BYTES
+    
+    total_lines = 0
+    previous_time = 0
+    current_bpm = bpm
+    last_instrument = first_instrument
+    
+    # Two-pointer merge of the chord and tempo streams, both already sorted
+    # by tick. A chord sharing a tick with a tempo change is emitted first.
+    tempo_idx = 0
+    total_tempos = len(tempo_changes)
+    
+    for time_point, notes_at_time, instrument_at_time in chords:
+        while tempo_idx < total_tempos and tempo_changes[tempo_idx][0] < time_point:
+            new_bpm = (60000000 / tempo_changes[tempo_idx][1])
+            if new_bpm != current_bpm:
+                write(b'\nBPM: %r' % new_bpm)
+                total_lines += 1
+                current_bpm = new_bpm
+            tempo_idx += 1
+        
+        if instrument_at_time != last_instrument:
+            write(b'\nInstr: %d' % instrument_at_time)
+            total_lines += 1
+            last_instrument = instrument_at_time
+        
+        if time_point > previous_time:
+            rest_ticks = time_point - previous_time
+            rest_beats = rest_ticks / ticks_per_beat
+            if rest_beats >= 0.03125:
+                rest_beats = round_beat(rest_beats)
+                write(b'\nRest: %r' % rest_beats)
+                total_lines += 1
+        
+        write(b'\nNote: ' + b'~'.join([note_bytes[n] for n in sorted(notes_at_time)]))
+        total_lines += 1
+        previous_time = time_point
+    
+    for _, tempo in tempo_changes[tempo_idx:]:
+        new_bpm = (60000000 / tempo)
+        if new_bpm != current_bpm:
+            write(b'\nBPM: %r' % new_bpm)
+            total_lines += 1
+            current_bpm = new_bpm
+    
+    return total_lines
+
+
+def _read_midi_mido(midi_file):
+    """Read note_on events and tempo changes with mido (pure Python)"""
+    mid = mido.MidiFile(midi_file)
+    
+    # Flat (absolute_time, note, instrument) tuples
+    note_ons = []
+    # (tick, tempo) pairs; a 120 BPM default applies until the first set_tempo
+    tempo_changes = [(0, 500000)]
+    
+    add_note_on = note_ons.append
     
     # Process all tracks
     for track_num, track in enumerate(mid.tracks):
         absolute_time = 0
-        current_program = 0
+        current_instrument = _GM_LUT[0]
         
         for msg in track:
             absolute_time += msg.time
+            msg_type = msg.type
             
-            if msg.type == 'note_on' and msg.velocity > 0:
-                events.append((absolute_time, 'note_on', {
-                    'note': msg.note,
-                    'velocity': msg.velocity,
-                    'channel': msg.channel,
-                    'program': current_program
-                }))
-            
-            elif msg.type == 'note_off' or (msg.type == 'note_on' and msg.velocity == 0):
-                events.append((absolute_time, 'note_off', {
-                    'note': msg.note,
-                    'channel': msg.channel
-                }))
+            if msg_type == 'note_on' and msg.velocity > 0:
+                add_note_on((absolute_time, msg.note, current_instrument))
             
-            elif msg.type == 'program_change':
-                current_program = msg.program
+            elif msg_type == 'program_change':
+                current_instrument = _GM_LUT[msg.program]
             
-            elif msg.type == 'set_tempo':
-                current_tempo = msg.tempo
-                tempo_changes[absolute_time] = current_tempo
+            elif msg_type == 'set_tempo':
+                tempo_changes.append((absolute_time, msg.tempo))
     
-    events.sort(key=lambda x: x[0])
-    
-    if not events:
-        return False, "No note events found in MIDI file!"
+    return mid.ticks_per_beat, note_ons, tempo_changes
+
+
+def _read_midi_symusic(midi_file):
+    """Read note_on events and tempo changes with symusic (C++ parser)"""
+    score = symusic.Score(midi_file)
     
-    output_lines = []
+    note_ons = []
+    tempo_changes = [(0, 500000)]
     
-    # Get initial instrument
-    first_instrument = 1
-    for time, event_type, data in events:
-        if event_type == 'note_on':
-            first_instrument = gm_to_scratch_instrument(data['program'])
-            break
+    # symusic splits tracks so that each one has a single program, tracking
+    # programs per channel rather than per track as the mido walk does. The
+    # split also changes which of several simultaneous notes comes first, so
+    # chord instruments ('Instr:' lines) can differ from the mido output.
+    # It also drops note_ons that are never followed by a note_off.
+    for track in score.tracks:
+        instrument = _GM_LUT[track.program]
+        notes = track.notes.numpy()
+        for time, note in zip(notes['time'].tolist(), notes['pitch'].tolist()):
+            note_ons.append((time, note, instrument))
     
-    output_lines.append(f"Instr: {first_instrument}")
+    for tempo in score.tempos:
+        tempo_changes.append((tempo.time, tempo.mspq))
     
-    # Get initial tempo
-    initial_tempo = tempo_changes.get(0, 500000)
-    bpm = (60000000 / initial_tempo)
-    output_lines.append(f"BPM: {bpm}")
+    return score.ticks_per_quarter, note_ons, tempo_changes
+
+
+def midi_to_scratch(midi_file, output_file, progress_callback=None):
+    """Convert MIDI file to Scratch-compatible format"""
     
-    note_end_times = {}
+    read_midi = _read_midi_symusic if symusic is not None else _read_midi_mido
+    try:
+        ticks_per_beat, note_ons, tempo_changes = read_midi(midi_file)
+    except Exception as e:
+        return False, f"Error reading MIDI file: {e}"
     
-    for time, event_type, data in events:
-        if event_type == 'note_off':
-            key = (data['channel'], data['note'])
-            note_end_times[key] = time
+    # Each track's events are already in time order, so this sort only has
+    # to merge one sorted run per track
+    note_ons.sort(key=itemgetter(0))
     
-    # Group notes that are very close together into chords
-    tolerance = ticks_per_beat / 32
-    grouped_events = []
-    processed_times = set()
-    
-    total_events = len(events)
-    for idx, (time, event_type, data) in enumerate(events):
-        if progress_callback and idx % 100 == 0:
-            progress_callback(idx / total_events * 100)
-        
-        if event_type != 'note_on':
-            continue
-        if time in processed_times:
-            continue
-            
-        chord_notes = []
-        chord_instrument = gm_to_scratch_instrument(data['program'])
-        
-        for other_time, other_type, other_data in events:
-            if other_type == 'note_on' and abs(other_time - time) <= tolerance:
-                chord_notes.append(other_data['note'])
-                processed_times.add(other_time)
-        
-        grouped_events.append((time, 'chord', {
-            'notes': chord_notes,
-            'program': data['program']
-        }))
+    if not note_ons:
+        return False, "No note events found in MIDI file!"
     
-    for time, tempo in tempo_changes.items():
-        if time > 0:
-            grouped_events.append((time, 'tempo', {'tempo': tempo}))
+    # Get initial instrument
+    first_instrument = note_ons[0][2]
     
-    grouped_events.sort(key=lambda x: x[0])
+    # Order tempo changes across tracks (each track is already monotonic);
+    # when several land on the same tick the last one read wins
+    tempo_changes.sort(key=itemgetter(0))
+    tempos = []
+    for tick, tempo in tempo_changes:
+        if tempos and tempos[-1][0] == tick:
+            tempos[-1] = (tick, tempo)
+        else:
+            tempos.append((tick, tempo))
     
-    previous_time = 0
-    current_bpm = bpm
-    last_instrument = first_instrument
+    # Get initial tempo
+    initial_tempo = tempos[0][1]
+    bpm = (60000000 / initial_tempo)
     
-    for time_point, event_type, data in grouped_events:
-        if event_type == 'tempo':
-            new_tempo = data['tempo']
-            new_bpm = (60000000 / new_tempo)
-            if new_bpm != current_bpm:
-                output_lines.append(f"BPM: {new_bpm}")
-                current_bpm = new_bpm
-            continue
-        
-        if event_type == 'chord':
-            notes_at_time = data['notes']
-            instrument_at_time = gm_to_scratch_instrument(data['program'])
-            
-            if instrument_at_time != last_instrument:
-                output_lines.append(f"Instr: {instrument_at_time}")
-                last_instrument = instrument_at_time
-            
-            if time_point > previous_time:
-                rest_ticks = time_point - previous_time
-                rest_beats = rest_ticks / ticks_per_beat
-                if rest_beats >= 0.03125:
-                    rest_beats = round_to_musical_beat(rest_beats)
-                    output_lines.append(f"Rest: {rest_beats}")
-            
-            output_lines.append(f"Note: {'~'.join(map(str, sorted(notes_at_time)))}")
-            previous_time = time_point
+    # Group notes that are very close together into chords
+    # Tick distances are integers, so flooring 1/32 beat keeps the comparison exact
+    tolerance_ticks = ticks_per_beat >> 5
+    chords = _group_chords(note_ons, tolerance_ticks, progress_callback)
     
+    # Stream lines straight to a large write buffer so memory stays bounded
     try:
-        with open(output_file, 'w') as f:
-            f.write('\n'.join(output_lines))
-        return True, f"Successfully converted!\nOutput: {output_file}\nTotal lines: {len(output_lines)}"
+        with open(output_file, 'wb', buffering=1 << 20) as f:
+            f.write(b'Instr: %d\nBPM: %r' % (first_instrument, bpm))
+            total_lines = 2 + _emit_lines(f.write, chords, tempos[1:], ticks_per_beat,
+                                          bpm, first_instrument)
+        return True, f"Successfully converted!\nOutput: {output_file}\nTotal lines: {total_lines}"
     except Exception as e:
         return False, f"Error writing output file: {e}"
 
 
 class MidiConverterGUI:
-    def __init__(self, root):
+    def __init__(self, root, batch_mode=False):
         self.root = root
+        # In batch mode results are shown in the status label instead of
+        # modal message boxes, so queued conversions run back to back
+        self.batch_mode = batch_mode
         self.root.title("MIDI to Scratch Converter")
         self.root.geometry("500x300")
         self.root.resizable(False, False)
@@ -262,8 +339,8 @@ class MidiConverterGUI:
         self.file_label = tk.Label(file_frame, text="No file selected", width=40, anchor="w", relief="sunken")
         self.file_label.pack(side=tk.LEFT, padx=5)
         
-        browse_btn = tk.Button(file_frame, text="Browse...", command=self.browse_file)
-        browse_btn.pack(side=tk.LEFT)
+        self.browse_btn = tk.Button(file_frame, text="Browse...", command=self.browse_file)
+        self.browse_btn.pack(side=tk.LEFT)
         
         # Convert button
         self.convert_btn = tk.Button(root, text="Convert to Scratch Format", command=self.convert, 
@@ -276,10 +353,17 @@ class MidiConverterGUI:
         self.progress.pack(pady=10)
         
         # Status label
-        self.status_label = tk.Label(root, text="", font=("Arial", 9))
+        self.status_label = tk.Label(root, text="", font=("Arial", 9), wraplength=460)
         self.status_label.pack(pady=5)
         
         self.midi_file = None
+        self.last_progress = 0
+        self.converting = False
+        self.pending_files = deque()
+        # Running batch summary, so one file's result doesn't hide another's
+        self.batch_total = 0
+        self.batch_converted = 0
+        self.batch_failed = []
     
     def browse_file(self):
         filename = filedialog.askopenfilename(
@@ -293,36 +377,100 @@ class MidiConverterGUI:
             self.convert_btn.config(state=tk.NORMAL)
             self.status_label.config(text="")
     
+    def convert_file(self, midi_file):
+        """Queue a MIDI file for conversion; queued files are converted one at a time"""
+        self.pending_files.append(midi_file)
+        self.batch_total += 1
+        if not self.converting:
+            self._convert_next()
+    
+    def _convert_next(self):
+        self.midi_file = self.pending_files.popleft()
+        self.file_label.config(text=os.path.basename(self.midi_file))
+        self.convert()
+    
     def update_progress(self, value):
+        if value - self.last_progress < 1:
+            return
+        self.last_progress = value
         self.progress['value'] = value
         self.root.update_idletasks()
     
     def convert(self):
-        if not self.midi_file:
+        # Only one conversion runs at a time
+        if not self.midi_file or self.converting:
             return
         
         # Generate output filename
         output_file = os.path.splitext(self.midi_file)[0] + "_scratch.txt"
         
+        self.converting = True
+        self.browse_btn.config(state=tk.DISABLED)
         self.convert_btn.config(state=tk.DISABLED)
         self.status_label.config(text="Converting...")
         self.progress['value'] = 0
+        self.last_progress = 0
         
-        success, message = midi_to_scratch(self.midi_file, output_file, self.update_progress)
+        # Convert off the Tk thread so the window stays responsive; Tk calls
+        # are marshalled back onto the mainloop with root.after
+        threading.Thread(target=self._do_convert, args=(self.midi_file, output_file), daemon=True).start()
+    
+    def _post(self, func, *args):
+        """Schedule func on the Tk thread; does nothing once the window is closed"""
+        try:
+            self.root.after(0, func, *args)
+        except (RuntimeError, tk.TclError):
+            pass
+    
+    def _do_convert(self, midi_file, output_file):
+        def report_progress(value):
+            self._post(self.update_progress, value)
         
+        # Always post a result, otherwise the UI and batch queue stay stuck
+        try:
+            success, message = midi_to_scratch(midi_file, output_file, report_progress)
+        except Exception as e:
+            success, message = False, f"Error converting MIDI file: {e}"
+        self._post(self._on_done, midi_file, success, message)
+    
+    def _on_done(self, midi_file, success, message):
         self.progress['value'] = 100
+        self.converting = False
         
-        if success:
+        if self.batch_mode:
+            if success:
+                self.batch_converted += 1
+            else:
+                self.batch_failed.append(os.path.basename(midi_file))
+                print(f"{midi_file}: {message}", file=sys.stderr)
+            
+            summary = f"{self.batch_converted}/{self.batch_total} converted"
+            if self.batch_failed:
+                summary += f", failed: {', '.join(self.batch_failed)}"
+            self.status_label.config(text=summary, fg="red" if self.batch_failed else "green")
+        elif success:
             messagebox.showinfo("Success!", message)
             self.status_label.config(text="Conversion complete!", fg="green")
         else:
             messagebox.showerror("Error", message)
             self.status_label.config(text="Conversion failed!", fg="red")
         
-        self.convert_btn.config(state=tk.NORMAL)
+        # Batch mode is driven through convert_file() only; manual conversions
+        # would bypass the batch counters
+        if not self.batch_mode:
+            self.browse_btn.config(state=tk.NORMAL)
+            self.convert_btn.config(state=tk.NORMAL)
+        
+        if self.pending_files:
+            self._convert_next()
 
 
 if __name__ == "__main__":
+    # MIDI files given on the command line are converted in batch mode
+    batch_files = sys.argv[1:]
+    
     root = tk.Tk()
-    app = MidiConverterGUI(root)
+    app = MidiConverterGUI(root, batch_mode=bool(batch_files))
+    for midi_file in batch_files:
+        app.convert_file(midi_file)
     root.mainloop()